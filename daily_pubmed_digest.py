@@ -2,21 +2,38 @@
 # -*- coding: utf-8 -*-
 
 """
-PubMed（複数検索式 or ジャーナルOR）→ Gemini(邦題+4点要約, 1コール/論文) → Gmail送信
+PubMed（複数検索式 or ジャーナルOR）→ Gemini(邦題+4点要約, GEMINI_BATCH_SIZE 本/コール) → Gmail送信
 - 毎日1回の実行想定（GitHub Actionsなど）
-- 送信済みPMIDは sent_pmids.json で重複防止（初回登録日時 added_at を記録）
+- 送信済みPMIDは sent_pmids.db（SQLite）で重複防止（初回登録日時 added_at を記録、旧 sent_pmids.json は初回に移行）
 - 要約は Google AI Studio の gemini-(1.5|2.5)-flash を想定
 """
 
-import os, json, time, ssl, smtplib, requests, re
-from string import Template
+import os, json, time, ssl, smtplib, requests, re, threading, sqlite3, itertools
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from datetime import datetime, timedelta, timezone
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
+from email.message import EmailMessage
 from email.utils import parseaddr
-from xml.etree import ElementTree as ET
+import lxml.etree as ET  # libxml2ベース（stdlib ElementTreeより高速）
 from google import genai
 from google.genai import types
+try:
+    import ahocorasick  # 任意（pyahocorasick）：国名エイリアスの一括走査に使用
+except ImportError:
+    ahocorasick = None
+try:
+    import hyperscan  # 任意：国名エイリアスを1つのDFAで走査（最優先）
+except ImportError:
+    hyperscan = None
+try:
+    import re2  # 任意（google-re2）：交替パターンを線形時間で走査
+except ImportError:
+    re2 = None
+try:
+    import orjson  # 任意：JSONの読み書きを高速化
+except ImportError:
+    orjson = None
 
 # ========= 環境変数 =========
 GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-2.5-flash")
@@ -27,25 +44,63 @@ GMAIL_ADDRESS = os.getenv("GMAIL_ADDRESS", "")
 GMAIL_APP_PASSWORD = os.getenv("GMAIL_APP_PASSWORD", "")
 PUBMED_TOOL_EMAIL = os.getenv("PUBMED_TOOL_EMAIL", GMAIL_ADDRESS)  # eutils &emailに使用（推奨）
 NCBI_API_KEY = os.getenv("NCBI_API_KEY", "")  # 任意（レート上限UP）
-SLEEP_BETWEEN_CALLS = float(os.getenv("SLEEP_BETWEEN_CALLS", "0.3"))  # 無料枠配慮
+SLEEP_BETWEEN_CALLS = float(os.getenv("SLEEP_BETWEEN_CALLS", "0.3"))  # GEMINI_RPM=0 のときの呼び出し間隔
+GEMINI_RPM = float(os.getenv("GEMINI_RPM", "10"))  # 1分あたりの上限（無料枠相当）。0ならSLEEP_BETWEEN_CALLS間隔
+GEMINI_RETRIES = int(os.getenv("GEMINI_RETRIES", "3"))  # 429（レート超過）時の再試行回数
+GEMINI_BACKOFF = float(os.getenv("GEMINI_BACKOFF", "10"))  # 再試行の待ち秒数（試行ごとに倍）
+GEMINI_CONCURRENCY = int(os.getenv("GEMINI_CONCURRENCY", "4"))  # 要約の同時実行数
+GEMINI_BATCH_SIZE = int(os.getenv("GEMINI_BATCH_SIZE", "4"))  # 1回の呼び出しでまとめて要約する論文数
 WINDOW_DAYS = int(os.getenv("WINDOW_DAYS", "2"))  # EDATの固定ウィンドウ（取りこぼし低減）
+MAX_NEW_PAPERS = int(os.getenv("MAX_NEW_PAPERS", "0"))  # 1回に処理する新規論文の上限（0なら無制限）
 TEMPERATURE = float(os.getenv("TEMPERATURE", "0.2"))
+LLM_ABSTRACT_LIMIT = 7000  # Geminiに渡すアブストラクトの最大文字数
+EFETCH_BATCH = int(os.getenv("EFETCH_BATCH", "200"))  # EFetch 1リクエストあたりのPMID数（200超はPOST推奨）
 
 # ========= PubMed E-utilities =========
 EUTILS_BASE = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/"
 TOOL_NAME = "pubmed-daily-digest"
-HEADERS = {"User-Agent": TOOL_NAME}
+HEADERS = {"User-Agent": TOOL_NAME, "Accept-Encoding": "gzip"}
+
+# E-utilities は1つの Session を使い回す（keep-alive で TLS ハンドシェイクを省略、429/5xx は自動リトライ）
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=8,
+    max_retries=Retry(
+        total=5,
+        backoff_factor=0.5,
+        status_forcelist=(429, 500, 502, 503, 504),
+        respect_retry_after_header=True,
+        allowed_methods=frozenset({"GET", "POST"}),  # EFetchのPOSTも冪等なのでリトライ対象
+    ),
+))
+
+# ========= JSON =========
+def _json_loads(raw):
+    """orjson があれば使い、失敗時（NaN等の非標準JSON）は stdlib にフォールバック"""
+    if orjson is not None:
+        try:
+            return orjson.loads(raw)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(raw)
+
+def _json_dumps(obj) -> str:
+    if orjson is not None:
+        return orjson.dumps(obj).decode("utf-8")
+    return json.dumps(obj, ensure_ascii=False)
 
 # ========= 状態保存 =========
-STATE_PATH = "sent_pmids.json"
+STATE_PATH = "sent_pmids.db"
+LEGACY_STATE_PATH = "sent_pmids.json"  # 旧形式（初回のみ SQLite へ移行）
 
-def load_sent_state():
+def _load_legacy_state():
     """sent_pmids.json を {pmid: {added_at: str}} で読み込む（旧listにも後方互換）"""
-    if not os.path.exists(STATE_PATH):
+    if not os.path.exists(LEGACY_STATE_PATH):
         return {}
     try:
-        with open(STATE_PATH, "r", encoding="utf-8") as f:
-            data = json.load(f)
+        with open(LEGACY_STATE_PATH, "rb") as f:
+            data = _json_loads(f.read())
         if isinstance(data, list):
             # 旧形式：["pmid", ...] → 新形式へ
             return {pmid: {"added_at": None} for pmid in data}
@@ -55,42 +110,119 @@ def load_sent_state():
         pass
     return {}
 
-def save_sent_state(state: dict):
-    with open(STATE_PATH, "w", encoding="utf-8") as f:
-        json.dump(state, f, ensure_ascii=False, indent=2, sort_keys=True)
+def open_sent_state():
+    """
+    送信済みPMIDの SQLite（sent(pmid, added_at)）を開く。
+    DBが未作成で sent_pmids.json があれば、その内容を一度だけ移行する。
+    """
+    migrate = not os.path.exists(STATE_PATH)
+    conn = sqlite3.connect(STATE_PATH)
+    conn.execute("CREATE TABLE IF NOT EXISTS sent(pmid TEXT PRIMARY KEY, added_at TEXT)")
+    if migrate:
+        legacy = _load_legacy_state()
+        with conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO sent VALUES (?, ?)",
+                [(pmid, (meta or {}).get("added_at")) for pmid, meta in legacy.items()],
+            )
+        if legacy:
+            print(f"{LEGACY_STATE_PATH} から {len(legacy)} 件を {STATE_PATH} へ移行")
+    return conn
+
+def load_sent_pmids(conn) -> set:
+    return {row[0] for row in conn.execute("SELECT pmid FROM sent")}
+
+def add_sent_pmids(conn, pmids, added_at: str):
+    """送信済みPMIDを1トランザクションで追加（既存の added_at は上書きしない）"""
+    with conn:
+        conn.executemany("INSERT OR IGNORE INTO sent VALUES (?, ?)", [(p, added_at) for p in pmids])
+
+def prune_sent_state(conn, days: int = 90) -> int:
+    """
+    added_at が `days` 日より前のレコードを削除し、削除件数を返す。
+    解析不能な日付や added_at 無しは安全側で残します（julianday が NULL になるため）。
+    """
+    cutoff_utc = (datetime.now(timezone.utc) - timedelta(days=days)).isoformat(timespec="seconds")
+    with conn:
+        cur = conn.execute(
+            "DELETE FROM sent WHERE julianday(added_at) < julianday(?)", (cutoff_utc,)
+        )
+    return cur.rowcount
+
+# ========= パース済みレコードのキャッシュ =========
+RECORD_CACHE_PATH = os.getenv("RECORD_CACHE_PATH", "parsed_records.sqlite")
 
-def prune_sent_state(state: dict, days: int = 90):
+def open_record_cache():
+    """
+    PMID → parse_records のレコードdict(JSON) を保持する SQLite キャッシュを開く。
+    途中で落ちても本体ファイルだけで完結するよう、WALではなく既定のロールバックジャーナルを使う。
+    """
+    conn = sqlite3.connect(RECORD_CACHE_PATH)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS records("
+        "pmid TEXT PRIMARY KEY, rec TEXT NOT NULL, cached_at TEXT NOT NULL)"
+    )
+    return conn
+
+def get_cached_records(conn, pmids) -> dict:
+    """キャッシュ済みのレコードを {pmid: rec} で返す（pmids の順序を保持）"""
+    found = {}
+    for pmid in pmids:
+        row = conn.execute("SELECT rec FROM records WHERE pmid = ?", (pmid,)).fetchone()
+        if row:
+            rec = _json_loads(row[0])
+            if "abstract_for_llm" not in rec:  # 古いキャッシュ行の補完
+                rec["abstract_for_llm"] = rec["abstract"][:LLM_ABSTRACT_LIMIT]
+            rec.setdefault("title_ja", "")
+            rec.setdefault("summary", "")
+            found[pmid] = rec
+    return found
+
+def cache_records(conn, records):
+    """レコードをキャッシュに書き込みながらそのまま yield する"""
+    for rec in records:
+        now_utc_iso = datetime.now(timezone.utc).isoformat(timespec="seconds")
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO records VALUES (?, ?, ?)",
+                (rec["pmid"], _json_dumps(rec), now_utc_iso),
+            )
+        yield rec
+
+def prune_record_cache(conn, done_pmids, days: int = 90):
     """
-    sent_pmids.json の {pmid: {"added_at": ISO8601}} から
-    added_at が `days` 日より前のレコードを削除して返す。
-    解析不能な日付や added_at 無しは安全側で残します。
-    return: (new_state, removed_count)
+    送信済みになったPMIDと、`days` 日より前にキャッシュしたレコードを削除する。
+    キャッシュは未送信のまま中断した回の再実行用なので、送信済みは不要。
     """
-    if not isinstance(state, dict):
-        return state, 0
+    cutoff = (datetime.now(timezone.utc) - timedelta(days=days)).isoformat(timespec="seconds")
+    with conn:
+        conn.executemany("DELETE FROM records WHERE pmid = ?", [(p,) for p in done_pmids])
+        conn.execute("DELETE FROM records WHERE cached_at < ?", (cutoff,))
 
-    cutoff_utc = datetime.now(timezone.utc) - timedelta(days=days)
-    kept, removed = {}, 0
+# ========= 並列実行・レート制御 =========
+def _start_rate_gate(interval: float):
+    """
+    interval 秒ごとに1枠ずつ補充されるセマフォ（容量1の簡易トークンバケット）を返す。
+    呼び出し側は acquire() してからリクエストする。補充はデーモンスレッドが行う。
+    """
+    gate = threading.BoundedSemaphore(1)
 
-    for pmid, meta in state.items():
-        ts = (meta or {}).get("added_at")
-        if not ts:
-            kept[pmid] = meta  # 移行直後などは残す（安全側）
-            continue
-        try:
-            dt = datetime.fromisoformat(ts)
-            if dt.tzinfo is None:
-                # 念のため（基本は +09:00 付きで保存されている想定）
-                dt = dt.replace(tzinfo=timezone.utc)
-            dt_utc = dt.astimezone(timezone.utc)
-            if dt_utc >= cutoff_utc:
-                kept[pmid] = meta
-            else:
-                removed += 1
-        except Exception:
-            kept[pmid] = meta  # パース失敗は残す（安全側）
+    def _refill():
+        while True:
+            time.sleep(interval)
+            try:
+                gate.release()
+            except ValueError:
+                pass  # 満杯なら捨てる
+
+    threading.Thread(target=_refill, daemon=True).start()
+    return gate
 
-    return kept, removed
+def _batched(iterable, n: int):
+    """iterable を n 件ずつのリストに区切って yield（itertools.batched は 3.12+ のため自前）"""
+    it = iter(iterable)
+    while chunk := list(itertools.islice(it, n)):
+        yield chunk
 
 # ========= PubMed検索 =========
 def build_journal_query(journals):
@@ -119,14 +251,24 @@ def pubmed_esearch(term):
     }
     if NCBI_API_KEY:
         params["api_key"] = NCBI_API_KEY
-    r = requests.get(EUTILS_BASE + "esearch.fcgi", params=params, headers=HEADERS, timeout=30)
+    r = _SESSION.get(EUTILS_BASE + "esearch.fcgi", params=params, headers=HEADERS, timeout=30)
     r.raise_for_status()
     data = r.json()
     return data.get("esearchresult", {}).get("idlist", [])
 
-def pubmed_efetch(pmids):
-    if not pmids:
-        return ""
+_NCBI_LOCK = threading.Lock()
+_NCBI_GATE = None
+
+def _ncbi_gate():
+    """NCBIのレート上限（APIキー有: 10 req/s、無: 3 req/s）に合わせたゲートを返す"""
+    global _NCBI_GATE
+    with _NCBI_LOCK:
+        if _NCBI_GATE is None:
+            _NCBI_GATE = _start_rate_gate(1.0 / (10 if NCBI_API_KEY else 3))
+        return _NCBI_GATE
+
+def _efetch_open(pmids):
+    """PMID一群を POST で EFetch し、本文を読む前のストリーミングレスポンスを返す"""
     params = {
         "db": "pubmed",
         "id": ",".join(pmids),
@@ -137,9 +279,26 @@ def pubmed_efetch(pmids):
     }
     if NCBI_API_KEY:
         params["api_key"] = NCBI_API_KEY
-    r = requests.get(EUTILS_BASE + "efetch.fcgi", params=params, headers=HEADERS, timeout=60)
+    _ncbi_gate().acquire()
+    r = _SESSION.post(EUTILS_BASE + "efetch.fcgi", data=params, headers=HEADERS, timeout=60, stream=True)
     r.raise_for_status()
-    return r.text
+    return r
+
+def pubmed_efetch(pmids):
+    """
+    PMIDを EFETCH_BATCH 件ずつに分けて並列に EFetch し、各バッチのレスポンス本文を
+    ファイルライクな生ストリーム（r.raw）として順に yield する。
+    本文全体を str にせず、受信しながら iterparse に流すため。
+    GETのURL長制限を避けるため POST を使う。
+    """
+    if not pmids:
+        return
+    chunks = [pmids[i:i + EFETCH_BATCH] for i in range(0, len(pmids), EFETCH_BATCH)]
+    with ThreadPoolExecutor(max_workers=3) as ex:
+        for r in ex.map(_efetch_open, chunks):
+            with r:
+                r.raw.decode_content = True  # gzip はここで展開
+                yield r.raw
 
 def load_multi_queries():
     """SEARCH_QUERIES（複数行・---区切り）を分割"""
@@ -149,22 +308,54 @@ def load_multi_queries():
     parts = re.split(r"(?m)^\s*---\s*$", raw)
     return [p.strip() for p in parts if p.strip()]
 
-def pubmed_multi_esearch_all(queries):
-    """複数クエリを順に検索し、PMIDを重複排除して返す"""
+def pubmed_multi_esearch_all(queries, skip=frozenset(), max_new=0):
+    """
+    複数クエリを順に検索し、skip（送信済み）を除いたPMIDを重複排除して返す。
+    max_new > 0 なら、新規PMIDがその件数に達した時点で残りのクエリを打ち切る。
+    """
     all_pmids = []
     seen = set()
     for q in queries:
         ids = pubmed_esearch(q)
         for pmid in ids:
-            if pmid not in seen:
-                seen.add(pmid)
-                all_pmids.append(pmid)
+            if pmid in skip or pmid in seen:
+                continue
+            seen.add(pmid)
+            all_pmids.append(pmid)
+            if max_new and len(all_pmids) >= max_new:
+                return all_pmids
         time.sleep(0.2)  # polite
     return all_pmids
 
 # ========= 文字列整形/抽出 =========
+_WS_RE = re.compile(r"\s+")
+
 def _norm_ws(s: str) -> str:
-    return re.sub(r"\s+", " ", (s or "")).strip()
+    return _WS_RE.sub(" ", (s or "")).strip()
+
+# PubmedArticle からのXPathはimport時に一度だけコンパイル（libxml2側で評価）。
+# 子孫探索 .// を避け、PubMed DTD どおりの直接パスで辿る。
+def _xp(path):
+    return ET.XPath(path, smart_strings=False)  # 文字列結果が元の木を参照し続けないように
+
+_XP_PMID = _xp("MedlineCitation/PMID/text()")
+_XP_TITLE = _xp("MedlineCitation/Article/ArticleTitle")
+_XP_ABSTRACT = _xp("MedlineCitation/Article/Abstract/AbstractText")
+_XP_AUTHORS = _xp("MedlineCitation/Article/AuthorList/Author")
+_XP_ANY_AFF = _xp("MedlineCitation/Article/AuthorList/Author/AffiliationInfo/Affiliation")
+_XP_JOURNAL_NAMES = (  # 略称優先の順
+    _xp("MedlineCitation/Article/Journal/ISOAbbreviation/text()"),
+    _xp("MedlineCitation/MedlineJournalInfo/MedlineTA/text()"),
+    _xp("MedlineCitation/Article/Journal/Title/text()"),
+)
+_XP_ARTICLE_DATES = _xp("MedlineCitation/Article/ArticleDate")
+_XP_PUBDATE = _xp("MedlineCitation/Article/Journal/JournalIssue/PubDate")
+_XP_HISTORY_DATE = _xp("PubmedData/History/PubMedPubDate[@PubStatus=$status]")
+_XP_PUBTYPES = _xp("MedlineCitation/Article/PublicationTypeList/PublicationType")
+_XP_DOI = _xp("PubmedData/ArticleIdList/ArticleId[@IdType='doi']/text()")
+
+def _first(nodes):
+    return nodes[0] if nodes else None
 
 def _itertext(elem) -> str:
     if elem is None:
@@ -172,32 +363,31 @@ def _itertext(elem) -> str:
     return _norm_ws("".join(elem.itertext()))
 
 def _prefer_abbrev(art) -> str:
-    for path in [".//Journal/ISOAbbreviation",
-                 ".//MedlineJournalInfo/MedlineTA",
-                 ".//Journal/Title"]:
-        val = art.findtext(path)
+    for xp in _XP_JOURNAL_NAMES:
+        val = _first(xp(art))
         if val and val.strip():
             return _norm_ws(val)
     return ""
 
 # --- 日付整形ヘルパー ---
-_MONTH_ABBR = {
-    "1":"Jan","01":"Jan","Jan":"Jan","January":"Jan",
-    "2":"Feb","02":"Feb","Feb":"Feb","February":"Feb",
-    "3":"Mar","03":"Mar","Mar":"Mar","March":"Mar",
-    "4":"Apr","04":"Apr","Apr":"Apr","April":"Apr",
-    "5":"May","05":"May","May":"May",
-    "6":"Jun","06":"Jun","Jun":"Jun","June":"Jun",
-    "7":"Jul","07":"Jul","Jul":"Jul","July":"Jul",
-    "8":"Aug","08":"Aug","Aug":"Aug","August":"Aug",
-    "9":"Sep","09":"Sep","Sep":"Sep","September":"Sep",
-    "10":"Oct","Oct":"Oct","October":"Oct",
-    "11":"Nov","Nov":"Nov","November":"Nov",
-    "12":"Dec","Dec":"Dec","December":"Dec",
+_MONTHS = ("", "Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec")
+_MONTH_NAMES = ("January", "February", "March", "April", "May", "June", "July",
+                "August", "September", "October", "November", "December")
+# 略称・正式名（小文字）→ 略称。"Mar-Apr" のような範囲や季節名は引かずにそのまま残す
+_MONTHS_BY_NAME = {
+    **{m.lower(): m for m in _MONTHS[1:]},
+    **{name.lower(): abbr for name, abbr in zip(_MONTH_NAMES, _MONTHS[1:])},
+    "sept": "Sep",
 }
+
 def _fmt_date(y, m, d):
     y = (y or "").strip()
-    m = _MONTH_ABBR.get((m or "").strip(), (m or "").strip())
+    m = (m or "").strip()
+    if m.isdigit():
+        if 1 <= int(m) <= 12:
+            m = _MONTHS[int(m)]
+    else:
+        m = _MONTHS_BY_NAME.get(m.lower(), m)
     d = (d or "").strip()
     if y and m and d:
         if d.isdigit() and len(d) == 1:
@@ -208,30 +398,30 @@ def _fmt_date(y, m, d):
     return y or ""
 
 def _extract_pubdate_display(art):
-    for ad in art.findall(".//Article/ArticleDate"):
+    article_dates = _XP_ARTICLE_DATES(art)
+    for ad in article_dates:
         dt = (ad.attrib or {}).get("DateType", "").lower()
         if dt == "electronic":
             return _fmt_date(ad.findtext("Year"), ad.findtext("Month"), ad.findtext("Day"))
-    ad = art.find(".//Article/ArticleDate")
+    ad = _first(article_dates)
     if ad is not None:
         s = _fmt_date(ad.findtext("Year"), ad.findtext("Month"), ad.findtext("Day"))
         if s: return s
-    y = art.findtext(".//JournalIssue/PubDate/Year")
-    m = art.findtext(".//JournalIssue/PubDate/Month")
-    d = art.findtext(".//JournalIssue/PubDate/Day")
-    s = _fmt_date(y, m, d)
-    if s: return s
-    md = (art.findtext(".//JournalIssue/PubDate/MedlineDate") or "").strip()
-    if md: return md
+    pd = _first(_XP_PUBDATE(art))
+    if pd is not None:
+        s = _fmt_date(pd.findtext("Year"), pd.findtext("Month"), pd.findtext("Day"))
+        if s: return s
+        md = (pd.findtext("MedlineDate") or "").strip()
+        if md: return md
     for status in ("pubmed", "entrez", "medline"):
-        ppd = art.find(f".//History/PubMedPubDate[@PubStatus='{status}']")
+        ppd = _first(_XP_HISTORY_DATE(art, status=status))
         if ppd is not None:
             return _fmt_date(ppd.findtext("Year"), ppd.findtext("Month"), ppd.findtext("Day"))
     return ""
 
 def _extract_pubtypes(art):
     pts, seen = [], set()
-    for pt in art.findall(".//PublicationTypeList/PublicationType"):
+    for pt in _XP_PUBTYPES(art):
         t = (pt.text or "").strip()
         if t and t not in seen:
             seen.add(t)
@@ -288,9 +478,100 @@ TLD_COUNTRY_MAP = {
     "us":"USA"
 }
 
+# 国名判定用の正規表現はimport時に一度だけコンパイル
+_EMAIL_TLD_RE = re.compile(r'@[\w.\-]+\.(\w+)')
+_COUNTRYISH_RE = re.compile(r"^[A-Za-zÀ-ÿ .'-]+$")
+# 全エイリアスを1本の交替パターンに（長い順）。
+# re では前後の区切り文字を先読み/後読みで判定する。先読み非対応の RE2 ではエイリアスだけを
+# 一致させ、区切り文字は他のバックエンドと同じく _alias_bounded で判定する。
+_ALIAS_ORDER = sorted(COUNTRY_ALIASES, key=len, reverse=True)
+_ALIAS_RANK = {a: i for i, a in enumerate(_ALIAS_ORDER)}  # 複数ヒット時の優先順位
+_ALIAS_ALT = "|".join(re.escape(a) for a in _ALIAS_ORDER)
+if re2 is not None:
+    _ALIAS_SCAN = re2.compile(r"(?i)(" + _ALIAS_ALT + r")")
+else:
+    # エイリアスごとにグループを分け、m.lastindex から辞書のキーを引く（ſ→s 等の大小無視で表記がずれても確実に引ける）
+    _ALIAS_SCAN = re.compile(r"(?i)(?<![^,\s;])(?:" + "|".join(f"({re.escape(a)})" for a in _ALIAS_ORDER)
+                             + r")(?=[,\s.;]|$)")
+
+def _alias_bounded(before: str, after: str) -> bool:
+    """エイリアス直前の文字が , ; 空白 か先頭、直後の文字が , . ; 空白 か末尾か"""
+    return (not before or before in ",;" or before.isspace()) and \
+           (not after or after in ",.;" or after.isspace())
+
+_HS_ALIASES = list(COUNTRY_ALIASES)
+
+def _build_alias_hs_db():
+    """hyperscan があれば全エイリアスを1つのデータベースにコンパイル（無ければ None）"""
+    if hyperscan is None:
+        return None
+    db = hyperscan.Database()
+    db.compile(
+        expressions=[re.escape(a).encode("utf-8") for a in _HS_ALIASES],
+        ids=list(range(len(_HS_ALIASES))),
+        elements=len(_HS_ALIASES),
+        flags=hyperscan.HS_FLAG_SOM_LEFTMOST | hyperscan.HS_FLAG_UTF8,
+    )
+    return db
+
+def _build_alias_automaton():
+    """pyahocorasick があれば全エイリアスを1つのオートマトンにまとめる（無ければ None）"""
+    if ahocorasick is None:
+        return None
+    A = ahocorasick.Automaton()
+    for alias in COUNTRY_ALIASES:
+        A.add_word(alias.lower(), alias.lower())
+    A.make_automaton()
+    return A
+
+_ALIAS_HS_DB = _build_alias_hs_db()
+_ALIAS_AUTOMATON = _build_alias_automaton() if _ALIAS_HS_DB is None else None
+
+def _scan_aliases(txt: str) -> list[str]:
+    """
+    affiliation全体を1回走査し、前後が区切り文字になっているエイリアスを列挙。
+    hyperscan → pyahocorasick → 交替パターン（RE2 / re）の順で使えるものを使う。
+    """
+    hits = []
+    if _ALIAS_HS_DB is not None:
+        low = txt.casefold().encode("utf-8")  # lower() だと ſ などが s に畳まれない
+
+        def _on_match(idx, start, end, flags, context):
+            # オフセットはバイト単位なので、前後1文字は UTF-8 として復元して判定（全角空白など）
+            before = low[max(0, start - 4):start].decode("utf-8", "ignore")[-1:]
+            after = low[end:end + 4].decode("utf-8", "ignore")[:1]
+            if _alias_bounded(before, after):
+                hits.append(_HS_ALIASES[idx])
+
+        _ALIAS_HS_DB.scan(low, match_event_handler=_on_match)
+        return hits
+    if _ALIAS_AUTOMATON is not None:
+        low = txt.casefold()
+        for end, alias in _ALIAS_AUTOMATON.iter(low):
+            start = end - len(alias) + 1
+            if _alias_bounded(low[start - 1:start] if start else "", low[end + 1:end + 2]):
+                hits.append(alias)
+        return hits
+    if re2 is not None:
+        pos = 0
+        while (m := _ALIAS_SCAN.search(txt, pos)) is not None:
+            start = m.start(1)
+            before = txt[start - 1:start] if start else ""
+            # RE2 は後読み/先読みが無いので、同じ開始位置で境界を満たす最長のエイリアスを探す
+            alias = next((a for a in _ALIAS_ORDER
+                          if len(a) <= len(m.group(1)) and txt[start:start + len(a)].casefold() == a
+                          and _alias_bounded(before, txt[start + len(a):start + len(a) + 1])), None)
+            if alias is not None:
+                hits.append(alias)
+                pos = start + len(alias)
+            else:
+                pos = start + 1
+        return hits
+    return [_ALIAS_ORDER[m.lastindex - 1] for m in _ALIAS_SCAN.finditer(txt)]
+
 def _normalize_country(name: str) -> str:
     if not name: return ""
-    key = re.sub(r"\s+", " ", name.strip().lower())
+    key = _WS_RE.sub(" ", name.strip().lower())
     return COUNTRY_ALIASES.get(key, name.strip())
 
 def _extract_country_from_aff(aff: str) -> str:
@@ -300,113 +581,167 @@ def _extract_country_from_aff(aff: str) -> str:
     txt = aff
 
     # 1) メールアドレスのTLDから推定
-    m = re.search(r'@[\w\.-]+\.(\w+)', txt)
+    m = _EMAIL_TLD_RE.search(txt)
     if m:
         tld = m.group(1).lower()
         if tld in TLD_COUNTRY_MAP:
             return TLD_COUNTRY_MAP[tld]
 
     # 2) 末尾側の ; / , 区切りから国名らしいトークンを拾う
-    tail = re.split(r'[;]', txt)[-1]  # ; の右側を優先
+    tail = txt.rsplit(";", 1)[-1]  # ; の右側を優先
     tokens = [t.strip(" .,") for t in tail.split(",") if t.strip(" .,")]
     for tok in reversed(tokens):
         norm = _normalize_country(tok)
         # エイリアスにヒット、または一般的な国名トークンなら採用
         if norm != tok or norm in COUNTRY_ALIASES.values():
             return COUNTRY_ALIASES.get(norm.lower(), norm)
-        if 2 <= len(tok) <= 40 and re.match(r"^[A-Za-zÀ-ÿ .'-]+$", tok):
+        if 2 <= len(tok) <= 40 and _COUNTRYISH_RE.match(tok):
             return tok  # 見た目が国名っぽければ採用
 
-    # 3) 全体テキストから既知国名エイリアスを検索
-    for alias in sorted(COUNTRY_ALIASES.keys(), key=len, reverse=True):
-        if re.search(rf'(?i)(^|[,\s;]){re.escape(alias)}([,\s.;]|$)', txt):
-            return COUNTRY_ALIASES[alias]
+    # 3) 全体テキストから既知国名エイリアスを1回の走査で検索（長い順→定義順で最優先のものを採用）
+    hits = _scan_aliases(txt)
+    if hits:
+        return COUNTRY_ALIASES[min(hits, key=_ALIAS_RANK.__getitem__)]
 
     return ""
 
-def parse_records(xml_text):
-    if not xml_text:
-        return []
-    root = ET.fromstring(xml_text)
-    results = []
-    for art in root.findall(".//PubmedArticle"):
-        pmid = (art.findtext(".//PMID") or "").strip()
-
-        # タイトル（<i>や<sup>を含めて）
-        title = _itertext(art.find(".//Article/ArticleTitle"))
-        if len(title) < 2:
-            print("WARN: suspicious title for PMID", pmid, "->", repr(title))
-
-        # アブストラクト
-        texts = []
-        for abs_elem in art.findall(".//Abstract/AbstractText"):
-            label = abs_elem.attrib.get("Label") if abs_elem.attrib else None
-            txt = _itertext(abs_elem)
-            if not txt: continue
-            texts.append(f"{label}: {txt}" if label else txt)
-        abstract = "\n".join(texts)
-
-        # --- 著者（筆頭のみ + 2名以上なら", et al."）＋ 国名のみ（不明なら付けない） ---
-        authors_nodes = art.findall(".//AuthorList/Author")
-        first_author_name, counted, aff_raw = "", 0, ""
-
-        for au in authors_nodes:
-            last = au.findtext("LastName") or ""
-            init = au.findtext("Initials") or ""
-            collective = au.findtext("CollectiveName") or ""
-            if last or init:
-                name = f"{last} {init}".strip()
-                if not first_author_name:
-                    first_author_name = name
-                    aff_elem = au.find("AffiliationInfo/Affiliation")
-                    aff_raw = _itertext(aff_elem) if aff_elem is not None else ""
-                counted += 1
-            elif collective:
-                if not first_author_name:
-                    first_author_name = collective
-                counted += 1
-
-        # 筆頭にAffiliationが無ければ記事全体からフォールバック
-        if not aff_raw:
-            any_aff = art.find(".//AffiliationInfo/Affiliation")
-            aff_raw = _itertext(any_aff) if any_aff is not None else ""
-
-        country = _extract_country_from_aff(aff_raw)  # 不明なら "" が返る
-
-        authors_display = first_author_name or ""
-        if counted >= 2 and authors_display:
-            authors_display += ", et al."
-        if country:
-            authors_display += f"（{country}）"
-
-        authors_line = authors_display  # ← このauthors_lineをresults.appendに渡す
-        
-        # ジャーナル（略称優先）
-        journal = _prefer_abbrev(art)
-
-        # Publication Type / 発行日 / DOI
-        pubtypes = _extract_pubtypes(art)
-        pubdate  = _extract_pubdate_display(art)
-        doi = ""
-        for aid in art.findall(".//ArticleIdList/ArticleId"):
-            if (aid.attrib or {}).get("IdType", "").lower() == "doi":
-                doi = (aid.text or "").strip()
-                break
-
-        results.append({
-            "pmid": pmid,
-            "title": title,
-            "authors": authors_line,
-            "journal": journal,
-            "pubdate": pubdate,
-            "doi": doi,
-            "url": f"https://pubmed.ncbi.nlm.nih.gov/{pmid}/",
-            "abstract": abstract,
-            "pt": pubtypes,
-        })
-    return results
+# libxml2 のパーサ設定：ID表を作らず、壊れたXMLも可能な範囲で読む。
+# 外部エンティティは展開しない（huge_tree も無効のまま）。
+# remove_blank_text は使わない：DTD無しだと <i>A</i> <i>B</i> の間の空白まで捨てられ、タイトル等が崩れるため。
+_PARSE_OPTS = dict(
+    recover=True,
+    collect_ids=False,
+    huge_tree=False,
+    resolve_entities=False,
+)
+
+def parse_records(xml_streams):
+    """
+    EFetchのXMLストリーム（読み取り可能なバイナリファイルライク）の列を
+    PubmedArticle 単位で iterparse し、レコードdictを1件ずつ yield する。
+    処理済みの要素は都度 clear して、DOM全体をメモリに保持しない。
+    recover=True でも致命的エラー（途中で切れた応答など）は握りつぶさず RuntimeError にする。
+    libxml2 が自分で閉じた PubmedArticle を正常なレコードとして流さないため。
+    """
+    for src in xml_streams:
+        context = ET.iterparse(src, events=("end",), tag="PubmedArticle", **_PARSE_OPTS)
+        for _, art in context:
+            _raise_on_fatal(context)
+            yield _record_from(art)
+            art.clear()
+            while art.getprevious() is not None:
+                del art.getparent()[0]
+        _raise_on_fatal(context)
+
+def _raise_on_fatal(context):
+    fatal = context.error_log.filter_from_level(ET.ErrorLevels.FATAL)
+    if fatal:
+        raise RuntimeError(f"EFetchのXMLを最後まで読めませんでした: {fatal[0]}")
+
+def _record_from(art) -> dict:
+    """PubmedArticle 要素1件からレコードdictを組み立てる"""
+    pmid = (_first(_XP_PMID(art)) or "").strip()
+
+    # タイトル（<i>や<sup>を含めて）
+    title = _itertext(_first(_XP_TITLE(art)))
+    if len(title) < 2:
+        print("WARN: suspicious title for PMID", pmid, "->", repr(title))
+
+    # アブストラクト
+    texts = []
+    for abs_elem in _XP_ABSTRACT(art):
+        label = abs_elem.attrib.get("Label") if abs_elem.attrib else None
+        txt = _itertext(abs_elem)
+        if not txt: continue
+        texts.append(f"{label}: {txt}" if label else txt)
+    abstract = "\n".join(texts)
+
+    # --- 著者（筆頭のみ + 2名以上なら", et al."）＋ 国名のみ（不明なら付けない） ---
+    authors_nodes = _XP_AUTHORS(art)
+    first_author_name, counted, aff_raw = "", 0, ""
+
+    for au in authors_nodes:
+        last = au.findtext("LastName") or ""
+        init = au.findtext("Initials") or ""
+        collective = au.findtext("CollectiveName") or ""
+        if last or init:
+            name = f"{last} {init}".strip()
+            if not first_author_name:
+                first_author_name = name
+                aff_elem = au.find("AffiliationInfo/Affiliation")
+                aff_raw = _itertext(aff_elem) if aff_elem is not None else ""
+            counted += 1
+        elif collective:
+            if not first_author_name:
+                first_author_name = collective
+            counted += 1
+
+    # 筆頭にAffiliationが無ければ記事全体からフォールバック
+    if not aff_raw:
+        aff_raw = _itertext(_first(_XP_ANY_AFF(art)))
+
+    country = _extract_country_from_aff(aff_raw)  # 不明なら "" が返る
+
+    authors_display = first_author_name or ""
+    if counted >= 2 and authors_display:
+        authors_display += ", et al."
+    if country:
+        authors_display += f"（{country}）"
+
+    authors_line = authors_display  # ← このauthors_lineを戻り値に渡す
+    
+    # ジャーナル（略称優先）
+    journal = _prefer_abbrev(art)
+
+    # Publication Type / 発行日 / DOI
+    pubtypes = _extract_pubtypes(art)
+    pubdate  = _extract_pubdate_display(art)
+    doi = (_first(_XP_DOI(art)) or "").strip()
+
+    return {
+        "pmid": pmid,
+        "title": title,
+        "authors": authors_line,
+        "journal": journal,
+        "pubdate": pubdate,
+        "doi": doi,
+        "url": f"https://pubmed.ncbi.nlm.nih.gov/{pmid}/",
+        "abstract": abstract,
+        "abstract_for_llm": abstract[:LLM_ABSTRACT_LIMIT] if len(abstract) > LLM_ABSTRACT_LIMIT else abstract,
+        "pt": pubtypes,
+        "title_ja": "",  # 要約後に埋める（メール整形で .get せずに済むよう全キーを用意）
+        "summary": "",
+    }
 
 # ========= Gemini（1回で邦題＋4点要約） =========
+_GEMINI_LOCK = threading.Lock()
+_GEMINI_CLIENT = None
+_GEMINI_GATE = None
+
+def _gemini_generate(prompt: str) -> str:
+    """共有クライアントでレート制限を守りつつ生成し、テキストを返す（スレッドセーフ）"""
+    global _GEMINI_CLIENT, _GEMINI_GATE
+    with _GEMINI_LOCK:
+        if _GEMINI_CLIENT is None:
+            _GEMINI_CLIENT = genai.Client()  # GEMINI_API_KEY は環境変数から
+            interval = 60.0 / GEMINI_RPM if GEMINI_RPM > 0 else SLEEP_BETWEEN_CALLS
+            _GEMINI_GATE = _start_rate_gate(interval) if interval > 0 else None
+    config = types.GenerateContentConfig(temperature=TEMPERATURE) # [0, 2]
+    for attempt in range(GEMINI_RETRIES + 1):
+        if _GEMINI_GATE is not None:
+            _GEMINI_GATE.acquire()
+        try:
+            resp = _GEMINI_CLIENT.models.generate_content(model=GEMINI_MODEL, contents=prompt, config=config)
+            return (_resp_to_text(resp) or "").strip()
+        except Exception as e:
+            if attempt >= GEMINI_RETRIES or not _is_rate_limited(e):
+                raise
+            time.sleep(GEMINI_BACKOFF * 2 ** attempt)  # 429 は指数バックオフして再試行
+
+def _is_rate_limited(e) -> bool:
+    """google-genai の APIError（code=429 / RESOURCE_EXHAUSTED）かどうか"""
+    return getattr(e, "code", None) == 429 or getattr(e, "status", None) == "RESOURCE_EXHAUSTED"
+
 def _resp_to_text(resp) -> str:
     if getattr(resp, "text", None):
         return resp.text
@@ -420,13 +755,15 @@ def _resp_to_text(resp) -> str:
         pass
     return "\n".join(parts)
 
+_JSON_RE = re.compile(r"\{[\s\S]*\}")
+
 def _force_json(text: str) -> dict:
     if not text:
         return {}
-    m = re.search(r"\{[\s\S]*\}", text)
+    m = _JSON_RE.search(text)
     raw = m.group(0) if m else text
     try:
-        data = json.loads(raw)
+        data = _json_loads(raw)
         return data if isinstance(data, dict) else {}
     except Exception:
         return {}
@@ -440,21 +777,8 @@ def _format_bullets(lines, target=4):
     xs = [x if len(x) <= 150 else (x[:147] + "…") for x in xs]
     return xs
     
-def translate_title_only(title: str) -> str:
-    """
-    アブストラクトなし論文向け：邦題のみを厳格JSONで生成し、title_ja を返す。
-    - 30〜45字、体言止め、冗長な副題は圧縮
-    - OS/PFS/Gy/fx/[18F] などの略語・表記は原文維持
-    - 外部知識・推測・要約文生成は禁止（タイトルのみを忠実に翻訳）
-    """
-    if not (title or "").strip():
-        return ""
-
-    client = genai.Client()
-    model_name = os.getenv("GEMINI_MODEL", "gemini-2.5-flash")
-    config=types.GenerateContentConfig(temperature=TEMPERATURE) # [0, 2]
-
-    prompt = Template("""You are a highly specialized AI assistant whose sole purpose is to produce a single strict JSON object with a Japanese title translation of a radiation oncology paper title, and nothing else.
+# 邦題のみ生成用プロンプトの固定部分（末尾に英題を連結する）
+_TITLE_PROMPT_PREFIX = """You are a highly specialized AI assistant whose sole purpose is to produce a single strict JSON object with a Japanese title translation of a radiation oncology paper title, and nothing else.
 
 ### Output (STRICT JSON ONLY)
 {
@@ -467,19 +791,22 @@ def translate_title_only(title: str) -> str:
 - Natural Japanese suitable for clinicians; avoid unnecessary punctuation.
 - If study design terms (e.g., 第II相試験) are NOT explicitly present in the English title, do not add them.
 
-English Title:
-$TITLE
-""").substitute(TITLE=title)
+"""
+
+def translate_title_only(title: str) -> str:
+    """
+    アブストラクトなし論文向け：邦題のみを厳格JSONで生成し、title_ja を返す。
+    - 30〜45字、体言止め、冗長な副題は圧縮
+    - OS/PFS/Gy/fx/[18F] などの略語・表記は原文維持
+    - 外部知識・推測・要約文生成は禁止（タイトルのみを忠実に翻訳）
+    """
+    if not (title or "").strip():
+        return ""
+
+    prompt = f"{_TITLE_PROMPT_PREFIX}English Title:\n{title}\n"
 
     try:
-        # JSON 強制（google-genai v1 以降で有効／古い版でも無害）
-        resp = client.models.generate_content(
-            model=model_name,
-            contents=prompt,
-            config=config
-        )
-        text = (_resp_to_text(resp) or "").strip()
-        data = _force_json(text)
+        data = _force_json(_gemini_generate(prompt))
         title_ja = (data.get("title_ja") or "").strip()
     except Exception:
         title_ja = ""
@@ -491,47 +818,7 @@ $TITLE
 
     return title_ja
 
-_PROMPT_TEMPLATE = Template("""You are a specialized summarizer for radiation oncology literature, tasked with creating concise Japanese summaries for busy radiation oncologists. Your output must be a strict JSON object.
-
-### JSON Output Format
-- **title_ja**: A Japanese title (30-45 characters, ending with a noun, compressing any lengthy subtitles, and including the study design from the original title only if explicitly mentioned).
-- **bullets**: An array of 4 or 5 bullet points, each with a character count between 60 and 120 (counting all characters, including full-width and half-width characters, as one). The bullets should be written in a consistent "da/dearu" style (e.g., "〜である", "〜した").
-
-### Key Rules
-- **Fact Extraction Only**: Summarize only the facts present in the provided title and abstract. Do not add external knowledge, rephrase information with different meanings, or make assumptions.
-- **Strictly JSON**: Output only the JSON object. Do not include any preceding or trailing text, or code blocks.
-
-### Language and Notation Policy
-- **International Abbreviations**: Use the original English for specific abbreviations like OS, PFS, LC, HR, CI, CR/PR, ORR, CTCAE, SUVmax, Gy, fx, SBRT/IMRT/VMAT/SIB/PBT, RT/CRT.
-- **Numerals & Units**: Use original numerals and units. If a value is not specified, state "数値記載なし".
-- **Chemicals/Tracers/Drugs**: Keep original notation (e.g., [18F], [68Ga], FAPI-46, nivolumab).
-- **General Terms**: Translate common English words into Japanese (e.g., patients→患者, toxicity→毒性, bleeding→出血, ulcer(s)→潰瘍).
-- **Slash Notation**: Naturalize expressions like "A/B" into "AやB" or "A・B". Replace "and/or" with "および／または" and "vs" with "対".
-- **Dose Fractionation**: Format dose fractionation in standard Japanese style (e.g., 5 x 7 Gy becomes "7 Gy × 5回").
-
-### Summarization Focus
-- **Target**: Cancer type, stage, patient count, inclusion criteria.
-- **Intervention**: Dose (Gy), fractionation (fx), site, modality (IMRT/VMAT/SBRT/SRS/particle therapy), concurrent therapy.
-- **Outcomes**: OS, PFS, LC, response rate, HR/CI, p-value, follow-up period.
-- **Safety**: CTCAE grade, adverse events.
-- **Imaging**: Nuclide/tracer, diagnostic metrics.
-- **Design**: Phase, randomization, single-arm, multi-institutional.
-
-### Instructions for creating "bullets"
-- Create 4 or 5 bullet points.
-- Each bullet point must have a character count strictly between 60 and 120 characters, counting all characters (including full-width and half-width characters) as one.
-- Summarize findings, avoiding interpretation or advice.
-- When a summary exceeds 120 characters, prioritize the removal of less critical information like p-values or HR/CI to fit the character limit.
-- The final bullet point should summarize the conclusion or main takeaway as stated in the abstract.
-
-English Title:
-$TITLE
-
-Abstract:
-$ABSTRACT
-""")
-
-PROMPT_TEMPLATE = Template("""You are a highly specialized AI assistant whose sole purpose is to create concise, accurate, and clinically relevant Japanese summaries of radiation oncology literature. Your target audience is busy Japanese radiation oncologists who need to quickly grasp the key takeaways of a study to inform their clinical practice. Your output must be a single, strict JSON object and nothing else.
+_PROMPT_RULES = """You are a highly specialized AI assistant whose sole purpose is to create concise, accurate, and clinically relevant Japanese summaries of radiation oncology literature. Your target audience is busy Japanese radiation oncologists who need to quickly grasp the key takeaways of a study to inform their clinical practice. Your output must be a single, strict JSON object and nothing else.
 
 ### Primary Goal
 To extract and summarize the most critical information (Intervention, Outcome, Patient/Problem, Study Design) so that a clinician can understand the study's essence in under 60 seconds.
@@ -578,30 +865,19 @@ Before generating the final JSON, follow these steps internally:
   ]
 }
 
-Now, process the following text based on all the rules above.
+"""
 
-English Title:
-$TITLE
+# 要約プロンプトの固定部分（import時に一度だけ連結。末尾に英題・アブストラクトを付ける）
+_PROMPT_PREFIX = _PROMPT_RULES + "Now, process the following text based on all the rules above.\n\n"
 
-Abstract:
-$ABSTRACT
-""")
+# 複数論文を1回の呼び出しで要約するときの指示（ルール部分は _PROMPT_RULES を共有）
+_BATCH_INSTRUCTIONS = """Now, process EACH paper in the following JSON object based on all the rules above. Summarize every paper independently and never mix facts between papers.
+Return a single strict JSON object of the form {"results": [{"id": "<same id as input>", "title_ja": "...", "bullets": ["...", "..."]}]} with exactly one entry per input paper.
 
-def summarize_title_and_bullets(title: str, abstract: str) -> dict:
-    client = genai.Client()  # GEMINI_API_KEY は環境変数から
-    model_name = os.getenv("GEMINI_MODEL", "gemini-2.5-flash")
-    config=types.GenerateContentConfig(temperature=TEMPERATURE) # [0, 2]
-    prompt = PROMPT_TEMPLATE.substitute(
-        TITLE=title,
-        ABSTRACT=(abstract[:7000] if abstract else "")
-    )
-    try:
-        resp = client.models.generate_content(model=model_name, contents=prompt, config=config)
-        text = (_resp_to_text(resp) or "").strip()
-        data = _force_json(text)
-    except Exception:
-        data = {}
+"""
 
+def _finish_summary(title: str, data: dict) -> dict:
+    """モデル出力（title_ja/bullets）を整形。邦題が空なら邦題のみ再生成"""
     title_ja = str((data.get("title_ja") or "")).strip()
     bullets  = _format_bullets(data.get("bullets"))
 
@@ -613,6 +889,62 @@ def summarize_title_and_bullets(title: str, abstract: str) -> dict:
 
     return {"title_ja": title_ja, "bullets": bullets}
 
+def summarize_title_and_bullets(title: str, abstract: str) -> dict:
+    """abstract は parse_records で切り詰め済みの abstract_for_llm を渡す"""
+    prompt = f"{_PROMPT_PREFIX}English Title:\n{title}\n\nAbstract:\n{abstract or ''}\n"
+    try:
+        data = _force_json(_gemini_generate(prompt))
+    except Exception:
+        data = {}
+    return _finish_summary(title, data)
+
+def summarize_batch(items: list[dict]) -> list[dict]:
+    """
+    複数論文を1回の呼び出しでまとめて要約し、items と同じ順で {title_ja, bullets} を返す。
+    - 呼び出し自体の失敗や results が配列でない場合は、バッチごと1回だけ再試行する。
+      それでも駄目なとき、原因がレート制限なら1本ずつには展開せず（悪化させないため）失敗表示を返し、
+      それ以外（JSONでない応答など）は1本ずつの要約にフォールバック。
+    - 応答はあるが該当idが欠けている論文だけ、1本ずつの要約にフォールバック。
+    """
+    if len(items) == 1:
+        return [summarize_title_and_bullets(items[0]["title"], items[0]["abstract_for_llm"])]
+    papers = [
+        {"id": it["pmid"], "title": it["title"], "abstract": it["abstract_for_llm"]}
+        for it in items
+    ]
+    prompt = _PROMPT_RULES + _BATCH_INSTRUCTIONS + _json_dumps({"papers": papers}) + "\n"
+    results = None
+    for attempt in range(2):
+        if attempt:
+            time.sleep(GEMINI_BACKOFF)
+        rate_limited = False
+        try:
+            results = _force_json(_gemini_generate(prompt)).get("results")
+        except Exception as e:
+            results = None
+            rate_limited = _is_rate_limited(e)
+        if isinstance(results, list):
+            break
+    else:
+        print(f"WARN: バッチ要約に失敗（{len(items)}件）:", ", ".join(it["pmid"] for it in items))
+        if rate_limited:
+            return [{"title_ja": "（邦題生成に失敗）", "bullets": _format_bullets([])} for _ in items]
+        return [summarize_title_and_bullets(it["title"], it["abstract_for_llm"]) for it in items]
+
+    by_id = {}
+    for r in results:
+        if isinstance(r, dict) and r.get("id") is not None:
+            by_id[str(r["id"]).strip()] = r
+
+    out = []
+    for it in items:
+        r = by_id.get(it["pmid"])
+        if r and r.get("bullets"):
+            out.append(_finish_summary(it["title"], r))
+        else:
+            out.append(summarize_title_and_bullets(it["title"], it["abstract_for_llm"]))
+    return out
+
 def _parse_recipients_env() -> list[str]:
     """
     RECIPIENT_EMAILS / RECIPIENT_EMAIL / GMAIL_ADDRESS の順に採用。
@@ -634,36 +966,38 @@ def _parse_recipients_env() -> list[str]:
     return emails
 
 # ========= メール整形・送信 =========
+def _format_email_item(i, it) -> str:
+    """論文1件分のブロック（parse_records が全キーを用意済みなので直接参照）"""
+    authors = f"\n著者：{it['authors']}" if it["authors"] else ""
+    pt = f"\n文献種別：{_format_pt_for_display(it['pt'])}" if it["pt"] else ""
+    return (
+        f"[論文{i}]\n"
+        f"原題：{it['title']}\n"
+        f"邦題（AI要約）：{it['title_ja']}{authors}\n"
+        f"雑誌名：{it['journal']}\n"
+        f"発行日：{it['pubdate']}{pt}\n"
+        f"Pubmed：{it['url']}\n"
+        f"DOI：{it['doi'] or '-'}\n"
+        f"要約（AI生成）：\n"
+        f"{it['summary']}\n\n"
+    )
+
 def build_email_body(date_jst_str, items):
-    lines = []
-    lines.append("新着論文AI要約配信\n")
-    lines.append("放射線腫瘍学\n\n")
-    lines.append(f"本日の新着論文は{len(items)}件です。\n\n")
-    for i, it in enumerate(items, 1):
-        lines.append(f"[論文{i}]")
-        lines.append(f"原題：{str(it.get('title',''))}")
-        lines.append(f"邦題（AI要約）：{str(it.get('title_ja',''))}")
-        if it.get('authors'):
-            lines.append(f"著者：{str(it.get('authors',''))}")
-        lines.append(f"雑誌名：{str(it.get('journal',''))}")
-        lines.append(f"発行日：{str(it.get('pubdate',''))}")
-        if it.get("pt"):
-            lines.append(f"文献種別：{_format_pt_for_display(it.get('pt', []))}")
-        lines.append(f"Pubmed：{str(it.get('url',''))}")
-        lines.append(f"DOI：{str(it.get('doi','') or '-')}")
-        lines.append("要約（AI生成）：")
-        lines.append(str(it.get('summary','')))
-        lines.append("\n")
-    return "\n".join(lines)
+    header = (
+        "新着論文AI要約配信\n",
+        "放射線腫瘍学\n\n",
+        f"本日の新着論文は{len(items)}件です。\n\n",
+    )
+    return "\n".join((*header, *(_format_email_item(i, it) for i, it in enumerate(items, 1))))
 
 def send_via_gmail(subject, body, recipients):
     if not (GMAIL_ADDRESS and GMAIL_APP_PASSWORD and recipients):
         raise RuntimeError("Gmail送信に必要な環境変数が不足しています（送信元/アプリパスワード/宛先）。")
 
-    msg = MIMEMultipart()
+    msg = EmailMessage()
     msg["From"] = GMAIL_ADDRESS
     msg["Subject"] = subject
-    msg.attach(MIMEText(body, "plain", "utf-8"))
+    msg.set_content(body, subtype="plain", charset="utf-8")
 
     mode = os.getenv("MULTI_SEND_MODE", "to").lower()
     if mode == "bcc":
@@ -679,62 +1013,66 @@ def send_via_gmail(subject, body, recipients):
     context = ssl.create_default_context()
     with smtplib.SMTP_SSL("smtp.gmail.com", 465, context=context) as server:
         server.login(GMAIL_ADDRESS, GMAIL_APP_PASSWORD)
-        server.sendmail(GMAIL_ADDRESS, envelope_to, msg.as_string())
+        server.send_message(msg, GMAIL_ADDRESS, envelope_to)  # Bcc ヘッダは送信時に除去される
 
 # ========= メイン =========
 def main():
     print("=== PubMed論文収集開始 ===")
 
+    # 送信済み状態のロード → ★ ここで剪定（検索中に送信済みを除外するため先に読む）
+    state = open_sent_state()
+    prune_days = int(os.getenv("PRUNE_DAYS", "90"))
+    pruned = prune_sent_state(state, prune_days)
+    if pruned:
+        print(f"古い送信記録を {pruned} 件削除（>{prune_days}日）")
+    sent_set = load_sent_pmids(state)
+
     queries = load_multi_queries()
     if queries:
-        pmids = pubmed_multi_esearch_all(queries)
+        new_pmids = pubmed_multi_esearch_all(queries, skip=sent_set, max_new=MAX_NEW_PAPERS)
     else:
         # フォールバック：JOURNALSをOR結合
         if not JOURNALS:
             raise SystemExit("環境変数 JOURNALS か SEARCH_QUERIES のいずれかを設定してください。")
-        pmids = pubmed_esearch(build_journal_query(JOURNALS))
+        new_pmids = [p for p in pubmed_esearch(build_journal_query(JOURNALS)) if p not in sent_set]
+        if MAX_NEW_PAPERS:
+            new_pmids = new_pmids[:MAX_NEW_PAPERS]
 
-    print(f"検索結果（重複前）: {len(pmids)}件")
-
-    # 送信済み状態のロード → ★ ここで剪定
-    state = load_sent_state()
-    prune_days = int(os.getenv("PRUNE_DAYS", "90"))
-    state, pruned = prune_sent_state(state, prune_days)
-    if pruned:
-        print(f"古い送信記録を {pruned} 件削除（>{prune_days}日）")
-
-    sent_set = set(state.keys())
-    new_pmids = [p for p in pmids if p not in sent_set]
     print(f"新規論文数: {len(new_pmids)}件")
 
-    items = []
+    items, cache = [], None
     if new_pmids:
-        xml = pubmed_efetch(new_pmids)
-        records = parse_records(xml)
+        # 前回までにパース済みのPMIDはキャッシュから読み、残りだけ EFetch する
+        cache = open_record_cache()
+        cached = get_cached_records(cache, new_pmids)
+        to_fetch = [p for p in new_pmids if p not in cached]
+        if cached:
+            print(f"キャッシュ済み: {len(cached)}件（EFetch対象: {len(to_fetch)}件）")
+        fetched = cache_records(cache, parse_records(pubmed_efetch(to_fetch)))
+        records = itertools.chain(cached.values(), fetched)  # ジェネレータ：パースしながら要約へ流す
 
         # JSTの現在時刻（ISO8601）を初回登録に記録
         jst = timezone(timedelta(hours=9))
         now_jst_iso = datetime.now(jst).isoformat(timespec="seconds")
 
-        print(f"\n{len(records)}件の新規論文を処理")
-        for idx, rec in enumerate(records, 1):
-            # 初回登録日時を state に保存（メールには出さない）
-            if rec["pmid"] not in state or not isinstance(state.get(rec["pmid"]), dict):
-                state[rec["pmid"]] = {"added_at": now_jst_iso}
-            elif not state[rec["pmid"]].get("added_at"):
-                state[rec["pmid"]]["added_at"] = now_jst_iso
-
-            # AI要約
-            print(f"要約中 ({idx}/{len(records)}): {rec['title'][:60]}...")
-            data = summarize_title_and_bullets(rec["title"], rec["abstract"] or "")
-            rec["title_ja"] = data["title_ja"]
-            rec["summary"]  = "\n".join(data["bullets"]) if rec["abstract"] else "・この論文にはPubMed上でアブストラクトが見つかりません"
-
-            time.sleep(SLEEP_BETWEEN_CALLS)
-            items.append(rec)
-
-        # 状態保存（added_atを含む）
-        save_sent_state(state)
+        print(f"\n{len(new_pmids)}件の新規論文を処理")
+        # AI要約はI/O待ちが主なのでスレッドで並列化（レートは _gemini_generate 側で制御）
+        with ThreadPoolExecutor(max_workers=GEMINI_CONCURRENCY) as ex:
+            futures, idx = [], 0
+            for batch in _batched(records, max(1, GEMINI_BATCH_SIZE)):
+                for rec in batch:
+                    idx += 1
+                    print(f"要約中 ({idx}/{len(new_pmids)}): {rec['title'][:60]}...")
+                futures.append((batch, ex.submit(summarize_batch, batch)))
+
+            for batch, fut in futures:
+                for rec, data in zip(batch, fut.result()):
+                    rec["title_ja"] = data["title_ja"]
+                    rec["summary"]  = "\n".join(data["bullets"]) if rec["abstract"] else "・この論文にはPubMed上でアブストラクトが見つかりません"
+                    items.append(rec)
+
+        # 状態保存（初回登録日時 added_at を記録。メールには出さない）
+        add_sent_pmids(state, [it["pmid"] for it in items], now_jst_iso)
 
     # メール送信（0件でも通知）
     print("\n=== メール送信 ===")
@@ -750,6 +1088,12 @@ def main():
 
     body = build_email_body(today, items)
     send_via_gmail(subject, body, recipients)
+    state.close()
+
+    # キャッシュの掃除はメール送信に成功してから（送信失敗時の再実行で使うため）
+    if cache is not None:
+        prune_record_cache(cache, [it["pmid"] for it in items], prune_days)
+        cache.close()
     print(f"送信済み：{len(recipients)} 宛先")
     
     print("\n=== 処理完了 ===")